@@ -1,25 +1,39 @@
 import os
+import sys
 import csv
 import logging
-from typing import Dict, Any, List
-import requests
+from typing import Dict, Any, List, Optional, Tuple
+import httpx
 import io
-import base64
+import pybase64
+import codecs
 import asyncio 
 import datetime 
-import json 
+import orjson
+import hashlib
+import pickle
+import operator
+import hmac
+import mmap
+import re
+import functools
+import html
+import array
+import weakref
 
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, ContextTypes, 
-    ApplicationBuilder, ConversationHandler
+    ApplicationBuilder, ConversationHandler, BaseUpdateProcessor
 )
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
+from cachetools import LRUCache
 # Импортируем Response для более гибкого управления HTTP-ответами
 from fastapi import FastAPI, Request, HTTPException, Response 
-from fastapi.responses import JSONResponse
 # ИМПОРТ ДЛЯ ОБСЛУЖИВАНИЯ АДМИН-ПАНЕЛИ
 from fastapi.staticfiles import StaticFiles 
+import uvicorn
 
 load_dotenv() 
 
@@ -27,17 +41,33 @@ load_dotenv()
 GETTING_ID, GETTING_ABSENCES = range(2)
 
 # --- КОНСТАНТЫ КЛАВИАТУРЫ ---
-USER_ID_KEY = 'registered_id'
 BTN_CHECK_PASSES = '📊 Посмотреть количество пропусков'
 BTN_CHANGE_ID = '✏️ Сменить номер'
-
-# --- ФУНКЦИИ КЛАВИАТУРЫ ---
-def get_main_keyboard():
-    keyboard = [[BTN_CHECK_PASSES], [BTN_CHANGE_ID]]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
-
-def remove_keyboard():
-    return ReplyKeyboardRemove()
+# Допустимый формат ID Номера (номер студенческого билета)
+_ID_RE = re.compile(r'\d{3,10}')
+
+# --- КЛАВИАТУРЫ ---
+# Клавиатуры неизменяемы, поэтому создаются один раз при импорте и переиспользуются
+MAIN_KEYBOARD = ReplyKeyboardMarkup([[BTN_CHECK_PASSES], [BTN_CHANGE_ID]], resize_keyboard=True, one_time_keyboard=False)
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+# --- ШАБЛОНЫ ОТВЕТОВ ---
+STUDENT_REPLY_TMPL = (
+    "👤 <b>Студент:</b> {name}\n"
+    "🆔 <b>ID:</b> <code>{sid}</code>\n"
+    "📚 <b>Количество пропусков (в часах):</b> {absences}\n\n"
+    "⏳ <i>Данные предоставлены за {updated}.</i>"
+)
+WELCOME_BACK_TMPL = (
+    'С возвращением! Ваш текущий ID Номер: <b>{sid}</b>.\n'
+    'Нажмите кнопку "📊 Посмотреть количество пропусков" ниже, чтобы узнать актуальные данные.\n\n'
+    '⏳ <i>Данные предоставлены за {updated}.</i>'
+)
+# Приветствие нового пользователя не зависит от данных и используется как есть
+WELCOME_TEXT = (
+    'Привет! 👋 Я бот для проверки пропусков в ВУЗе.\n'
+    'Для начала работы, пожалуйста, <b>введите свой ID Номер</b> (номер студенческого билета).'
+)
 
 # --- ПАРАМЕТРЫ GITHUB ---
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
@@ -46,12 +76,125 @@ REPO_DETAILS_FULL = os.getenv("GIT_REPO_DETAILS")
 CSV_URL = os.getenv("CSV_URL") 
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", 1234567890)) 
 
+# URL и заголовки GitHub API вычисляются один раз при запуске, а не при каждой загрузке или коммите
+_REPO_PARTS = REPO_DETAILS_FULL.split('/', 3) if REPO_DETAILS_FULL else []
+if len(_REPO_PARTS) == 4:
+    GH_USER, GH_REPO, GH_BRANCH, GH_FILEPATH = _REPO_PARTS
+    CONTENTS_URL = f"https://api.github.com/repos/{GH_USER}/{GH_REPO}/contents/{GH_FILEPATH}?ref={GH_BRANCH}"
+    COMMITS_URL = f"https://api.github.com/repos/{GH_USER}/{GH_REPO}/commits?path={GH_FILEPATH}&sha={GH_BRANCH}&per_page=1"
+else:
+    GH_USER = GH_REPO = GH_BRANCH = GH_FILEPATH = CONTENTS_URL = COMMITS_URL = None
+COMMITS_HEADERS = {
+    "Authorization": f"token {GITHUB_TOKEN}",
+    "Accept": "application/vnd.github.v3+json"
+}
+CONTENTS_HEADERS = {
+    "Authorization": f"token {GITHUB_TOKEN}",
+    "Accept": "application/vnd.github.com.v3.sha", # Более точный Accept для SHA
+}
+# Тело PUT сериализуется через orjson вручную, поэтому Content-Type указываем сами
+CONTENTS_PUT_HEADERS = {**CONTENTS_HEADERS, "Content-Type": "application/json"}
+# Период фонового обновления данных с GitHub в секундах (0 — отключено)
+REFRESH_INTERVAL = int(os.getenv("REFRESH_INTERVAL", 300))
+# Правки пропусков копятся и отправляются одним коммитом после паузы в COMMIT_DELAY секунд,
+# но не позже COMMIT_MAX_DELAY секунд после первой правки пачки (иначе непрерывные правки откладывали бы коммит бесконечно)
+COMMIT_DELAY = int(os.getenv("COMMIT_DELAY", 15))
+COMMIT_MAX_DELAY = int(os.getenv("COMMIT_MAX_DELAY", 120))
+# Регистрации пользователей сохраняются в pickle раз в USER_STATE_FLUSH_INTERVAL секунд и при остановке
+USER_STATE_PATH = os.getenv("USER_STATE_PATH", "/tmp/user_ids.pkl")
+USER_STATE_FLUSH_INTERVAL = 60
+# Локальный pickle-кэш разобранных данных (ключ — git blob SHA содержимого CSV)
+DATA_CACHE_PATH = os.getenv("DATA_CACHE_PATH", "/tmp/students.pkl")
+
 # --- ПАРАМЕТРЫ WEBHOOK (Для Render) ---
 WEBHOOK_PATH = "/telegram" 
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET")
 PORT = int(os.getenv("PORT", 10000))
 LISTEN_HOST = os.getenv("HOST", "0.0.0.0")
 TELEGRAM_API_URL = "https://api.telegram.org/bot"
+# Сколько принятых апдейтов может одновременно ждать в очереди или обрабатываться:
+# сверх этого webhook отвечает 503 и Telegram повторит доставку позже
+MAX_PENDING_UPDATES = 1000
+# Сколько апдейтов PTB обрабатывает одновременно (обработчики в основном ждут ответа Bot API).
+# Апдейты одного пользователя при этом идут строго по очереди (см. PerUserUpdateProcessor)
+CONCURRENT_UPDATES = 8
+
+# --- HTTP-КЛИЕНТ TELEGRAM BOT API ---
+class OrjsonHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, который разбирает ответы Bot API через orjson вместо стандартного json."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> Dict[str, Any]:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # Некорректный UTF-8 и прочие ошибки обрабатывает стандартная реализация PTB
+            return HTTPXRequest.parse_json_payload(payload)
+
+# --- ОБРАБОТКА АПДЕЙТОВ ---
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает апдейты разных пользователей параллельно, а апдейты одного пользователя — по очереди.
+    ConversationHandler (/edit_pass) рассчитывает на последовательную обработку: иначе ID, введенный
+    сразу после команды, увидит старое состояние диалога и попадет в handle_message.
+
+    Заодно считает принятые, но еще не обработанные апдейты. PTB забирает апдейты из update_queue
+    сразу и создает задачу на каждый, поэтому ограничить их число размером очереди нельзя:
+    webhook резервирует место через try_reserve(), а освобождается оно по окончании обработки.
+
+    Замок пользователя берется уже внутри общего слота (process_update в PTB финальный),
+    поэтому пачка сообщений одного пользователя может временно занять несколько слотов.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._max_pending_updates = max_pending_updates
+        self._pending_updates = 0
+        # Замок живет, пока его держит или ждет хотя бы один апдейт пользователя
+        self._user_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+    def try_reserve(self) -> bool:
+        """Резервирует место под новый апдейт; False, если лимит MAX_PENDING_UPDATES исчерпан."""
+        if self._pending_updates >= self._max_pending_updates:
+            return False
+        self._pending_updates += 1
+        return True
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        try:
+            user = update.effective_user if isinstance(update, Update) else None
+            if user is None:
+                await coroutine
+                return
+
+            lock = self._user_locks.get(user.id)
+            if lock is None:
+                lock = self._user_locks[user.id] = asyncio.Lock()
+            async with lock:
+                await coroutine
+        finally:
+            self._pending_updates -= 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# --- HTTP-КЛИЕНТ GITHUB ---
+# Общий асинхронный клиент с пулом соединений: запросы к GitHub не блокируют цикл событий.
+# HTTP/2 позволяет запросам к api.github.com идти параллельно по одному соединению.
+# Keep-alive 75 секунд: серия правок и /reload_data идут по уже открытому TLS-соединению
+HTTP_LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=75)
+HTTP_CLIENT = httpx.AsyncClient(http2=True, timeout=10, limits=HTTP_LIMITS)
+# Временные ошибки GitHub (5xx, обрыв соединения) повторяются с экспоненциальной паузой,
+# чтобы администратору не приходилось заново проходить диалог правки
+GITHUB_RETRY_STATUSES = frozenset((500, 502, 503, 504))
+GITHUB_RETRIES = 3
+GITHUB_RETRY_BACKOFF = 0.3
+GITHUB_RETRY_MAX_DELAY = 10
 
 # --- ЛОГИРОВАНИЕ ---
 logging.basicConfig(
@@ -61,130 +204,465 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # --- ДАННЫЕ СТУДЕНТОВ ---
-STUDENT_DATA: Dict[str, Dict[str, Any]] = {} 
+# Хранятся как структура массивов: ID номер -> индекс строки, плюс параллельные ФИО и пропуски
+IDS: Dict[str, int] = {}
+NAMES: List[str] = []
+ABSENCES: array.array = array.array('i')
+# Верхняя граница значения в ABSENCES (знаковый 32-битный int массива 'i')
+MAX_ABSENCES = 2**31 - 1
+# Готовые тексты ответов по ID номеру; сбрасываются при каждой загрузке данных
+REPLY_CACHE: Dict[str, str] = {}
+# Исходные строки последнего загруженного CSV: при редактировании меняется только строка студента
+CSV_LINES: List[str] = []
+# Номер строки в CSV_LINES для каждого индекса студента (-1, если запись занимает несколько строк)
+ROW_LINES: array.array = array.array('i')
+# (разделитель, индекс столбца пропусков, перевод строки) либо None, если точечная правка невозможна
+CSV_LAYOUT: Optional[Tuple[str, int, str]] = None
+# --- РЕГИСТРАЦИЯ ПОЛЬЗОВАТЕЛЕЙ ---
+# Telegram user id -> ID номер студента. Ограниченный LRU в памяти процесса вместо context.user_data
+USER_ID_MAP: LRUCache = LRUCache(maxsize=100_000)
+# Есть ли в USER_ID_MAP изменения, еще не записанные в USER_STATE_PATH
+_user_ids_dirty = False
+_user_state_task: Optional[asyncio.Task] = None
+# Запись регистраций, которая идет в потоке (может пережить отмену фоновой задачи)
+_user_ids_write: Optional[asyncio.Future] = None
+# ETag последнего успешно загруженного RAW CSV (для условного GET с If-None-Match)
+_csv_etag: Optional[str] = None
+# ETag ответа Commits API: если последний коммит файла тот же, GitHub ответит 304 (не тратит лимит запросов)
+_commits_etag: Optional[str] = None
+# SHA и дата (MSK) последнего коммита файла из ответа с этим ETag
+_commits_sha: Optional[str] = None
+_commits_date: Optional[str] = None
+# SHA коммита, содержимое которого сейчас загружено: пока он последний, RAW CSV не скачиваем
+_loaded_commit_sha: Optional[str] = None
+# SHA файла на GitHub из ответа на последний коммит бота или из скачанного CSV (позволяет не запрашивать его перед PUT)
+_cached_file_sha: Optional[str] = None
+# git blob SHA последнего скачанного RAW CSV
+_csv_blob_sha: Optional[str] = None
 # --- ГЛОБАЛЬНАЯ ПЕРЕМЕННАЯ ДЛЯ ДАТЫ ОБНОВЛЕНИЯ ---
 LAST_UPDATED_TIME: str = "Неизвестно" 
 
 # --- ГЛОБАЛЬНЫЙ ЭКЗЕМПЛЯР PTB Application ---
 application: Application = None 
+# Фоновая задача периодического обновления данных
+_refresh_task: Optional[asyncio.Task] = None
+# --- ОТЛОЖЕННЫЕ ПРАВКИ ---
+# ID номер -> новое количество пропусков, еще не закоммиченное на GitHub
+PENDING_EDITS: Dict[str, int] = {}
+_last_edit_at: float = 0.0
+_flush_task: Optional[asyncio.Task] = None
+_flush_lock = asyncio.Lock()
+# Сериализует загрузки данных с GitHub
+_data_load_lock = asyncio.Lock()
+# Установлен, когда данные доступны (снимок или первая загрузка); до этого webhook отвечает 503
+DATA_READY = asyncio.Event()
 
 
 # --- ФУНКЦИИ ЗАГРУЗКИ / ПАРСИНГА ДАННЫХ ---
-def parse_csv_data(csv_content: str) -> bool:
-    """Парсит содержимое CSV-файла (строка) и заполняет STUDENT_DATA."""
-    global STUDENT_DATA
-    STUDENT_DATA = {}
+def _decode_csv(csv_content: bytes) -> str:
+    """Декодирует скачанный CSV из UTF-8 одним проходом, отбрасывая BOM."""
+    return csv_content.decode('utf-8-sig', errors='replace')
+
+
+def _split_csv_lines(csv_content: str) -> List[str]:
+    """Разбивает содержимое CSV на физические строки, отбрасывая пустые строки в начале и в конце файла."""
+    lines = csv_content.lstrip('\ufeff').splitlines()
+    # Края обрезаются по списку строк, а не strip() всего текста — это лишняя полная копия файла
+    start, end = 0, len(lines)
+    while start < end and not lines[start].strip():
+        start += 1
+    while end > start and not lines[end - 1].strip():
+        end -= 1
+    return lines[start:end] if start or end < len(lines) else lines
+
+
+def _detect_newline(csv_content: str) -> str:
+    """Определяет перевод строки файла по первой строке, чтобы правка не меняла его во всем файле."""
+    first_break = csv_content.find('\n')
+    return '\r\n' if first_break > 0 and csv_content[first_break - 1] == '\r' else '\n'
+
+
+def _parse_columns(rows: List[List[str]], id_col: int, fio_col: int, abs_col: int, row_width: int) -> Optional[Tuple[Dict[str, int], List[str], array.array]]:
+    """
+    Разбирает строки CSV целыми столбцами через map/zip, без Python-цикла по строкам.
+    Возвращает None, если файл требует построчной обработки: короткие строки, пустые или повторяющиеся ID,
+    нечисловые или выходящие за MAX_ABSENCES значения пропусков.
+    """
+    if not rows or min(map(len, rows)) < row_width:
+        return None
+    
+    # Интернированные ID сравниваются с интернированным вводом по указателю
+    student_ids = list(map(sys.intern, map(str.strip, map(operator.itemgetter(id_col), rows))))
+    ids = dict(zip(student_ids, range(len(student_ids))))
+    if len(ids) != len(student_ids) or '' in ids:
+        return None
+    
+    try:
+        absences = array.array('i', map(int, map(operator.itemgetter(abs_col), rows)))
+    except (ValueError, OverflowError):
+        return None
+    if min(absences) < -MAX_ABSENCES:
+        return None
+    
+    names = list(map(str.strip, map(operator.itemgetter(fio_col), rows)))
+    if '' in names:
+        names = [name or 'Неизвестно' for name in names]
     
-    if csv_content.startswith('\ufeff'):
-        csv_content = csv_content.lstrip('\ufeff')
+    return ids, names, absences
+
+
+@functools.lru_cache(maxsize=4)
+def _parse_csv(csv_bytes: bytes) -> Optional[Tuple[Dict[str, int], List[str], array.array, List[str], array.array, Optional[Tuple[str, int, str]]]]:
+    """
+    Разбирает содержимое CSV-файла (байты UTF-8) в индекс ID номеров и параллельные массивы ФИО и пропусков.
+    Дополнительно возвращает строки файла, номер строки каждого студента и раскладку столбцов
+    для точечной правки CSV при редактировании.
+    Результат кэшируется по содержимому: повторная загрузка неизменного файла не парсит его заново.
+    Возвращает None, если разобрать файл не удалось.
+    """
+    ids: Dict[str, int] = {}
+    names: List[str] = []
+    # Пропуски собираются в обычный список и превращаются в array('i') одним вызовом в конце
+    absences_col: List[int] = []
+    row_lines = array.array('i')
+    
+    if csv_bytes.startswith(codecs.BOM_UTF8):
         logger.info("⚠️ Обнаружен и удален BOM (Byte Order Mark) из CSV-содержимого.")
+    
+    # Байты ответа декодируются здесь один раз, без промежуточного response.text
+    csv_content = _decode_csv(csv_bytes)
         
     try:
-        delimiter_char = ';' 
-        
-        csv_lines = csv_content.strip().splitlines() 
+        csv_lines = _split_csv_lines(csv_content)
         
         if not csv_lines:
             logger.warning("❌ CSV-содержимое пусто или состоит только из пробельных символов. Данные не загружены.")
-            return False
+            return None
 
         header_line = csv_lines[0].strip()
         
         if not header_line:
              logger.error("❌ Первая строка CSV (заголовок) пуста после очистки. Парсинг невозможен.")
-             return False
-             
-        fieldnames = [name.strip() for name in header_line.split(delimiter_char)]
-        fieldnames = [name for name in fieldnames if name]
+             return None
         
-        if not fieldnames:
+        # Разделитель определяем по заголовку: поддерживаются ';' и '|'
+        delimiter_char = '|' if header_line.count('|') > header_line.count(';') else ';'
+        
+        # Заголовок читает тот же csv.reader, что и данные (учитываются кавычки в именах столбцов)
+        # csv.reader читает уже готовый список строк — без повторной склейки файла в StringIO
+        reader = csv.reader(csv_lines, delimiter=delimiter_char)
+        fieldnames = [name.strip() for name in next(reader)]
+        
+        if not any(fieldnames):
              logger.error("❌ Заголовки CSV-файла пусты или содержат пустые столбцы после очистки. Парсинг невозможен.")
-             return False
+             return None
+
+        student_id_key = 'ID номер'
+        absences_key = 'Количество пропусков'
+        fio_key = 'ФИО'
+
+        if student_id_key not in fieldnames:
+             logger.error(f"❌ В заголовке CSV нет столбца '{student_id_key}'. Заголовок: {fieldnames}")
+             return None
+
+        # Индексы нужных столбцов вычисляем один раз по заголовку.
+        # Отсутствующий столбец указывает на виртуальную пустую ячейку в конце строки.
+        missing_col = len(fieldnames)
+        id_col = fieldnames.index(student_id_key)
+        fio_col = fieldnames.index(fio_key) if fio_key in fieldnames else missing_col
+        abs_col = fieldnames.index(absences_key) if absences_key in fieldnames else missing_col
+        row_width = max(id_col, fio_col, abs_col) + 1
+        pick_fields = operator.itemgetter(id_col, fio_col, abs_col)
+        # Без столбца пропусков менять нечего — при редактировании файл будет собран целиком
+        layout = (delimiter_char, abs_col, _detect_newline(csv_content)) if abs_col != missing_col else None
+
+        if len(csv_lines) == 1:
+             logger.warning(f"⚠️ В CSV-файле найден только заголовок, нет строк данных. Проверьте ваш CSV. Заголовок: {fieldnames}")
+             return ids, names, array.array('i'), csv_lines, row_lines, layout
+        
+        logger.info(f"🔍 Заголовки CSV: {fieldnames} (ID: {id_col}, ФИО: {fio_col}, пропуски: {abs_col})")
 
-        data_lines = csv_lines[1:] 
+        # Если каждая запись занимает одну строку, пробуем разобрать файл целыми столбцами
+        rows = list(reader)
+        columns = _parse_columns(rows, id_col, fio_col, abs_col, row_width) if len(rows) == len(csv_lines) - 1 else None
         
-        if not data_lines:
-             logger.warning(f"⚠️ В CSV-файле найден только заголовок, нет строк данных. Проверьте ваш CSV. Заголовок: {fieldnames}")
-             return True 
-
-        data_io = io.StringIO('\n'.join(data_lines))
-        reader = csv.DictReader(data_io, fieldnames=fieldnames, delimiter=delimiter_char)
-        
-        logger.info(f"🔍 Заголовки, использованные для DictReader: {fieldnames}")
-
-        record_count = 0
-        for row in reader:
-            if not row or all(not v for v in row.values()):
-                 continue
-                 
-            record_count += 1
-            processed_row = {}
-            for k, v in row.items():
-                safe_v = v if v is not None else '' 
-                processed_row[k] = safe_v.strip()
-            row = processed_row
-            
-            student_id_key = 'ID номер'
-            absences_key = 'Количество пропусков'
-            fio_key = 'ФИО'
-            
-            student_id_raw = row.get(student_id_key)
-            student_id = student_id_raw.strip() if student_id_raw else None 
-            
-            if student_id:
-                absences_str = row.get(absences_key, '0')
+        if columns is not None:
+            ids, names, absences_arr = columns
+            row_lines = array.array('i', range(1, len(names) + 1))
+        else:
+            # Построчный разбор для файлов с пустыми/повторяющимися ID, многострочными значениями и т.п.
+            # Здесь строки склеиваются обратно: только так csv сохраняет переводы строк внутри кавычек
+            reader = csv.reader(io.StringIO('\n'.join(csv_lines)), delimiter=delimiter_char)
+            next(reader)
+            line_start = reader.line_num
+            for row in reader:
+                # Запись в кавычках может занимать несколько физических строк — такие не правим точечно
+                line_no = line_start if reader.line_num - line_start == 1 else -1
+                line_start = reader.line_num
+
+                if len(row) < row_width:
+                    row.extend([''] * (row_width - len(row)))
+
+                raw_id, raw_name, raw_absences = pick_fields(row)
+                # Интернированные ID сравниваются с интернированным вводом по указателю
+                student_id = sys.intern(raw_id.strip())
+                if not student_id:
+                     continue
+
                 try:
-                    absences = int(absences_str)
+                    absences = int(raw_absences)
                 except ValueError:
                     absences = 0
 
-                STUDENT_DATA[student_id] = {
-                    fio_key: row.get(fio_key, 'Неизвестно'),
-                    absences_key: absences
-                }
+                if abs(absences) > MAX_ABSENCES:
+                    absences = 0
+
+                name = raw_name.strip() or 'Неизвестно'
+                idx = ids.get(student_id)
+                if idx is None:
+                    ids[student_id] = len(names)
+                    names.append(name)
+                    absences_col.append(absences)
+                    row_lines.append(line_no)
+                else:
+                    # Повторяющийся ID: как и раньше, побеждает последняя строка
+                    names[idx] = name
+                    absences_col[idx] = absences
+                    row_lines[idx] = line_no
+
+            absences_arr = array.array('i', absences_col)
         
-        logger.info(f"✅ Данные успешно загружены. Загружено {len(STUDENT_DATA)} записей. (Фиксированный разделитель: '{delimiter_char}')")
-        return True
+        logger.info(f"✅ CSV разобран. Записей: {len(names)}. (Разделитель: '{delimiter_char}')")
+        return ids, names, absences_arr, csv_lines, row_lines, layout
     
     except Exception as e:
-        logger.error(f"❌ Ошибка при парсинге CSV-данных. Проверьте заголовок 'ID номер' и разделитель (должен быть ';'). Ошибка: {e}")
+        logger.error(f"❌ Ошибка при парсинге CSV-данных. Проверьте заголовок 'ID номер' и разделитель (';' или '|'). Ошибка: {e}")
         try:
              first_line = csv_content.strip().splitlines()[0] if csv_content.strip() else "Данные отсутствуют или пусты"
         except:
              first_line = "Ошибка извлечения первой строки"
 
         logger.error(f"❌ Первая строка CSV (для отладки): '{first_line}'")
+        return None
+
+
+async def parse_csv_data(csv_content: bytes) -> bool:
+    """Парсит содержимое CSV-файла (байты) в отдельном потоке и заполняет IDS, NAMES и ABSENCES."""
+    global IDS, NAMES, ABSENCES, CSV_LINES, ROW_LINES, CSV_LAYOUT
+    
+    # Разбор — чистая работа CPU: в потоке он не останавливает обработку webhook-запросов.
+    # Подмена данных ниже выполняется уже в потоке цикла событий
+    parsed = await asyncio.to_thread(_parse_csv, csv_content)
+    if parsed is None:
+        return False
+    
+    # Разобранный результат хранится в lru_cache, а пропуски и строки CSV меняются при редактировании — берем копии.
+    # Новый снимок собран целиком заранее и подменяется одним присваиванием
+    ids, names, absences_arr, csv_lines, row_lines, layout = parsed
+    IDS, NAMES, ABSENCES, CSV_LINES, ROW_LINES, CSV_LAYOUT = \
+        ids, names, array.array('i', absences_arr), list(csv_lines), row_lines, layout
+    
+    logger.info(f"✅ Данные успешно загружены. Загружено {len(IDS)} записей.")
+    return True
+
+
+# --- КЭШ РАЗОБРАННЫХ ДАННЫХ ---
+def read_data_cache(content_digest: Optional[str] = None, csv_content: Optional[bytes] = None) -> Optional[Tuple]:
+    """
+    Читает pickle-кэш и, если он построен по тому же содержимому CSV, возвращает готовый снимок данных.
+    Глобальные переменные не трогает, поэтому безопасно вызывается в отдельном потоке.
+    """
+    try:
+        # Файл кэша отображается в память и разбирается pickle напрямую, без построчного чтения
+        with open(DATA_CACHE_PATH, 'rb') as cache_file, \
+                mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ) as cache_map:
+            cached = pickle.loads(cache_map)
+
+        if content_digest is not None and cached.get('digest') != content_digest:
+            return None
+
+        ids, names, absences_arr, row_lines, layout = cached['data']
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось прочитать кэш данных {DATA_CACHE_PATH}: {e}")
+        return None
+
+    # Сами строки в кэше не хранятся: разбить уже скачанный текст на строки дешевле, чем читать их из pickle
+    if csv_content is not None:
+        csv_lines = _split_csv_lines(_decode_csv(csv_content))
+    else:
+        # Исходного текста нет — до первой загрузки с GitHub правки соберут CSV целиком
+        csv_lines, layout = [], None
+    return ids, names, absences_arr, csv_lines, row_lines, layout, cached.get('updated'), cached.get('digest')
+
+
+def apply_data_cache(snapshot: Tuple) -> None:
+    """Подменяет данные снимком из read_data_cache одним присваиванием."""
+    global IDS, NAMES, ABSENCES, CSV_LINES, ROW_LINES, CSV_LAYOUT
+
+    IDS, NAMES, ABSENCES, CSV_LINES, ROW_LINES, CSV_LAYOUT = snapshot[:6]
+    logger.info(f"✅ Данные загружены из кэша {DATA_CACHE_PATH} без парсинга CSV. Записей: {len(IDS)}")
+
+
+def load_data_from_cache() -> bool:
+    """Холодный старт: принимает любой сохраненный снимок вместе с его датой обновления."""
+    global LAST_UPDATED_TIME, _cached_file_sha
+
+    snapshot = read_data_cache()
+    if snapshot is None:
         return False
+    apply_data_cache(snapshot)
+    updated_time, content_digest = snapshot[6:]
+    LAST_UPDATED_TIME = updated_time or LAST_UPDATED_TIME
+    # Блоб SHA снимка годится для PUT, пока файл на GitHub не изменился (иначе 409 и повтор с актуальным SHA)
+    _cached_file_sha = content_digest
+    return True
+
+
+def save_data_to_cache(content_digest: str, updated_time: str, data: Tuple) -> None:
+    """
+    Сохраняет снимок (IDS, NAMES, ABSENCES, ROW_LINES, CSV_LAYOUT) в pickle-кэш вместе с хэшем исходного CSV.
+    Пишет файл на диск, поэтому из цикла событий вызывается через asyncio.to_thread.
+    """
+    # Как и для регистраций: временный файл и подмена, чтобы перезапуск посреди записи не оставил битый кэш
+    tmp_path = f"{DATA_CACHE_PATH}.tmp"
+    try:
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump(
+                {'digest': content_digest, 'updated': updated_time, 'data': data},
+                cache_file,
+                protocol=5
+            )
+        os.replace(tmp_path, DATA_CACHE_PATH)
+    except OSError as e:
+        logger.warning(f"⚠️ Не удалось записать кэш данных {DATA_CACHE_PATH}: {e}")
+
+
+# --- СОХРАНЕНИЕ РЕГИСТРАЦИЙ ПОЛЬЗОВАТЕЛЕЙ ---
+def load_user_ids() -> None:
+    """Восстанавливает USER_ID_MAP из USER_STATE_PATH, чтобы после перезапуска не регистрироваться заново."""
+    try:
+        with open(USER_STATE_PATH, 'rb') as state_file:
+            saved_ids = pickle.load(state_file)
+        # ID номера интернируются заново, как и при вводе пользователем
+        USER_ID_MAP.update((user_id, sys.intern(student_id)) for user_id, student_id in saved_ids.items())
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось прочитать сохраненные регистрации {USER_STATE_PATH}: {e}")
+        return
+    logger.info(f"✅ Восстановлено регистраций пользователей: {len(USER_ID_MAP)}")
 
 
-def load_data_from_git() -> bool:
+def write_user_ids(saved_ids: Dict[int, str]) -> None:
+    """Записывает копию USER_ID_MAP в USER_STATE_PATH. Выполняется в отдельном потоке."""
+    global _user_ids_dirty
+
+    # Пишем во временный файл и подменяем: оборванная запись не испортит прошлое состояние
+    tmp_path = f"{USER_STATE_PATH}.tmp"
+    try:
+        with open(tmp_path, 'wb') as state_file:
+            pickle.dump(saved_ids, state_file, protocol=5)
+        os.replace(tmp_path, USER_STATE_PATH)
+    except OSError as e:
+        _user_ids_dirty = True
+        logger.warning(f"⚠️ Не удалось сохранить регистрации {USER_STATE_PATH}: {e}")
+
+
+async def save_user_ids() -> None:
+    """
+    Сохраняет USER_ID_MAP, если с прошлой записи были изменения. Копия снимается в цикле событий,
+    а pickle и запись на диск идут в потоке и не задерживают обработку апдейтов.
+    """
+    global _user_ids_dirty, _user_ids_write
+
+    # Запись из отмененной фоновой задачи могла еще идти в потоке — новая начнется только после нее
+    if _user_ids_write is not None:
+        await asyncio.wait((_user_ids_write,))
+    if not _user_ids_dirty:
+        return
+    _user_ids_dirty = False
+
+    _user_ids_write = asyncio.ensure_future(asyncio.to_thread(write_user_ids, dict(USER_ID_MAP)))
+    await asyncio.shield(_user_ids_write)
+
+
+async def periodic_user_ids_flush() -> None:
+    """Фоновая задача: сбрасывает регистрации на диск пачкой, а не на каждое сообщение."""
+    while True:
+        await asyncio.sleep(USER_STATE_FLUSH_INTERVAL)
+        await save_user_ids()
+
+
+async def github_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Выполняет запрос к GitHub через HTTP_CLIENT, повторяя его при 5xx и сетевых ошибках."""
+    for attempt in range(GITHUB_RETRIES + 1):
+        delay = GITHUB_RETRY_BACKOFF * 2 ** attempt
+        try:
+            response = await HTTP_CLIENT.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt == GITHUB_RETRIES:
+                raise
+            logger.warning(f"⚠️ Сетевая ошибка {method} {url}: {e}. Повтор через {delay:.1f} с.")
+        else:
+            if response.status_code not in GITHUB_RETRY_STATUSES or attempt == GITHUB_RETRIES:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, min(int(retry_after), GITHUB_RETRY_MAX_DELAY))
+            logger.warning(f"⚠️ GitHub ответил HTTP {response.status_code} на {method} {url}. Повтор через {delay:.1f} с.")
+        await asyncio.sleep(delay)
+
+
+def git_blob_sha(content: bytes) -> str:
+    """Вычисляет git blob SHA содержимого файла — так же, как его считает GitHub."""
+    blob_hash = hashlib.sha1(b"blob %d\0" % len(content))
+    blob_hash.update(content)
+    return blob_hash.hexdigest()
+
+
+def publish_loaded_data(updated_time: str) -> None:
+    """Публикует дату обновления и сбрасывает готовые ответы — в том же шаге, что и подмена данных."""
+    global LAST_UPDATED_TIME
+    LAST_UPDATED_TIME = updated_time
+    REPLY_CACHE.clear()
+
+
+async def load_data_from_git(force: bool = False) -> bool:
     """
     Загружает данные, скачивая файл с GitHub по прямому URL, 
     и получает дату последнего обновления через GitHub API.
+    С force=True (/reload_data) файл скачивается заново, даже если его коммит уже загружен.
     """
-    global LAST_UPDATED_TIME
+    # Фоновое обновление, /reload_data и перезагрузка после коммита не должны выполняться одновременно
+    async with _data_load_lock:
+        return await _load_data_from_git(force)
+
+
+async def fetch_last_commit_info() -> Tuple[str, Optional[str]]:
+    """Запрашивает у Commits API дату (MSK) и SHA последнего коммита файла."""
+    global _commits_etag, _commits_sha, _commits_date
     
-    # --- 1. Получение даты последнего обновления ---
-    if not CSV_URL or not GITHUB_TOKEN or not REPO_DETAILS_FULL:
-        logger.error("❌ Отсутствуют необходимые переменные: CSV_URL, GITHUB_TOKEN или GIT_REPO_DETAILS. Дата обновления будет 'Неизвестно'.")
-        LAST_UPDATED_TIME = "Неизвестно"
+    updated_time = "Неизвестно"
+    commit_sha = None
+    try:
+        if COMMITS_URL is None:
+            raise ValueError(f"ожидался формат user/repo/branch/path, получено '{REPO_DETAILS_FULL}'")
         
-        if not CSV_URL:
-             return False
-    else:
-        # Получение даты последнего обновления
-        try:
-            user, repo, branch, filepath = REPO_DETAILS_FULL.split('/', 3)
-            
-            commits_url = f"https://api.github.com/repos/{user}/{repo}/commits?path={filepath}&sha={branch}&per_page=1"
-            headers = {
-                "Authorization": f"token {GITHUB_TOKEN}",
-                "Accept": "application/vnd.github.v3+json"
-            }
-            
-            response_commit = requests.get(commits_url, headers=headers, timeout=5)
+        headers = {**COMMITS_HEADERS, "If-None-Match": _commits_etag} if _commits_etag else COMMITS_HEADERS
+        response_commit = await github_request("GET", COMMITS_URL, headers=headers, timeout=5)
+        
+        if response_commit.status_code == 304:
+            # Новых коммитов нет — дата берется из ответа с этим ETag, а не из опубликованной:
+            # если данные этого коммита еще не загрузились, LAST_UPDATED_TIME относится к предыдущему
+            updated_time = _commits_date
+            commit_sha = _commits_sha
+            logger.info(f"✅ Новых коммитов нет (HTTP 304). Дата обновления: {updated_time}")
+        else:
+            _commits_etag = _commits_sha = _commits_date = None
             response_commit.raise_for_status()
-            commit_list = response_commit.json()
+            commit_list = orjson.loads(response_commit.content)
             
             if commit_list and 'commit' in commit_list[0]:
                 commit_date_iso = commit_list[0]['commit']['author']['date']
@@ -192,28 +670,131 @@ def load_data_from_git() -> bool:
                 dt_utc = datetime.datetime.fromisoformat(commit_date_iso.replace('Z', '+00:00'))
                 dt_msk = dt_utc.astimezone(datetime.timezone(datetime.timedelta(hours=3))) 
                 
-                LAST_UPDATED_TIME = dt_msk.strftime("%d.%m.%Y в %H:%M MSK")
-                logger.info(f"✅ Дата последнего обновления: {LAST_UPDATED_TIME}")
+                updated_time = dt_msk.strftime("%d.%m.%Y в %H:%M MSK")
+                commit_sha = _commits_sha = commit_list[0].get('sha')
+                _commits_date = updated_time
+                _commits_etag = response_commit.headers.get("ETag")
+                logger.info(f"✅ Дата последнего обновления: {updated_time}")
                 
             else:
-                LAST_UPDATED_TIME = "Не найдено"
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка получения даты обновления (Commit API). Проверьте GITHUB_TOKEN и REPO_DETAILS_FULL. Ошибка: {e}")
-            LAST_UPDATED_TIME = "Неизвестно" 
+                updated_time = "Не найдено"
+            
+    except Exception as e:
+        _commits_etag = _commits_sha = _commits_date = None
+        logger.error(f"❌ Ошибка получения даты обновления (Commit API). Проверьте GITHUB_TOKEN и REPO_DETAILS_FULL. Ошибка: {e}")
+    
+    return updated_time, commit_sha
+
+
+async def _load_data_from_git(force: bool) -> bool:
+    """Одна загрузка данных с GitHub; вызывается только под _data_load_lock."""
+    global _csv_etag, _loaded_commit_sha, _csv_blob_sha, _cached_file_sha
+    
+    # Новая дата копится в локальной переменной и публикуется только вместе с новыми данными
+    # (см. publish_loaded_data): пока идут сетевые запросы и при любой ошибке обработчики видят целиком старый снимок
+    updated_time = "Неизвестно"
+    commit_sha = None
+    
+    # Если файл не менялся с прошлой загрузки, сервер ответит 304 без тела
+    raw_headers = {"If-None-Match": _csv_etag} if _csv_etag and IDS and not force else {}
+    # Данных нет совсем (холодный старт без снимка, webhook отвечает 503) — RAW CSV качаем
+    # параллельно с запросом к Commits API: хосты разные, ожидания не складываются
+    raw_task = None
+    if CSV_URL and not IDS:
+        raw_task = asyncio.create_task(github_request("GET", CSV_URL, headers=raw_headers, timeout=10))
+    
+    # --- 1. Получение даты последнего обновления ---
+    if not CSV_URL or not GITHUB_TOKEN or not REPO_DETAILS_FULL:
+        logger.error("❌ Отсутствуют необходимые переменные: CSV_URL, GITHUB_TOKEN или GIT_REPO_DETAILS. Дата обновления будет 'Неизвестно'.")
+        
+        if not CSV_URL:
+             return False
+    else:
+        updated_time, commit_sha = await fetch_last_commit_info()
             
     # --- 2. Получение RAW контента ---
+    # Последний коммит файла тот же, что уже загружен — CSV не скачиваем и не разбираем
+    if not force and raw_task is None and commit_sha and commit_sha == _loaded_commit_sha and IDS:
+        logger.info(f"✅ Коммит {commit_sha[:7]} уже загружен. Используются текущие данные.")
+        return True
+    
     try:
-        response = requests.get(CSV_URL, timeout=10)
-        response.encoding = 'utf-8' 
+        if raw_task is not None:
+            response = await raw_task
+        else:
+            response = await github_request("GET", CSV_URL, headers=raw_headers, timeout=10)
+    except httpx.HTTPError as e:
+        logger.error(f"❌ Ошибка при скачивании файла с GitHub ({CSV_URL}): {e}")
+        return False
+    
+    try:
+        if response.status_code == 304:
+            logger.info("✅ CSV не изменился (HTTP 304). Используются уже загруженные данные.")
+            if commit_sha and commit_sha != _loaded_commit_sha:
+                file_sha = await fetch_github_file_sha()
+                if file_sha is not None:
+                    _cached_file_sha = file_sha
+                    if file_sha == _csv_blob_sha:
+                        # Файл на новом коммите совпадает с загруженным — данные те же, обновляется только дата
+                        _loaded_commit_sha = commit_sha
+                        publish_loaded_data(updated_time)
+            return True
+        
         response.raise_for_status()
         
-        content_start = response.text[:100].replace('\n', '\\n').replace('\r', '\\r')
+        # Для лога декодируем только начало файла; весь CSV парсер получает байтами
+        content_start = response.content[:100].decode('utf-8', errors='ignore').replace('\n', '\\n').replace('\r', '\\r')
         logger.info(f"✅ Успешный ответ (HTTP {response.status_code}). Начало контента: '{content_start}...'")
         
-        return parse_csv_data(response.text)
+        # Ключ кэша — git blob SHA содержимого: тот же SHA, который Contents API ждет при коммите
+        content_digest = git_blob_sha(response.content)
+        
+        # CDN raw.githubusercontent.com может отдать старую версию файла, хотя Commits API уже видит
+        # новый коммит. Коммит считается загруженным, а его дата публикуется, только если SHA файла
+        # из Contents API совпал со скачанным содержимым
+        file_sha = await fetch_github_file_sha() if commit_sha else None
+        verified = file_sha is not None and file_sha == content_digest
+        if file_sha is not None and not verified and IDS:
+            # Старой версией не затираем текущие данные (в том числе только что закоммиченные правки бота)
+            _cached_file_sha = file_sha
+            logger.warning("⚠️ Скачанный CSV не совпадает с текущим файлом на GitHub (кэш CDN). Данные обновятся при следующей загрузке.")
+            return False
+        
+        # Если содержимое не изменилось с прошлого запуска, берем готовый результат из кэша.
+        # Чтение и запись pickle идут в отдельном потоке, чтобы не задерживать обработку апдейтов
+        snapshot = await asyncio.to_thread(read_data_cache, content_digest, response.content)
+        cache_data = None
+        if snapshot is not None:
+            apply_data_cache(snapshot)
+        else:
+            if not await parse_csv_data(response.content):
+                return False
+            # Кэш хранит файл как есть: ABSENCES копируем до применения неотправленных правок
+            cache_data = (IDS, NAMES, ABSENCES[:], ROW_LINES, CSV_LAYOUT)
+        
+        # Подмена данных (в parse_csv_data/apply_data_cache), публикация даты и повторное применение правок
+        # проходят одним шагом event loop — без await между ними
+        publish_loaded_data(updated_time if verified or not commit_sha else LAST_UPDATED_TIME)
+        # Состояние загрузки меняется только после успешной подмены данных: при ошибке разбора
+        # следующая загрузка должна снова скачать файл, а не счесть коммит уже загруженным
+        _loaded_commit_sha = commit_sha if verified else None
+        if file_sha is not None:
+            _cached_file_sha = file_sha
+        elif content_digest != _csv_blob_sha:
+            # SHA файла подойдет для следующего PUT без лишнего GET. Старое содержимое, повторно скачанное
+            # из кэша CDN после нашего коммита, SHA из ответа PUT не затирает
+            _cached_file_sha = content_digest
+        _csv_blob_sha = content_digest
+        # Еще не отправленные правки не должны пропасть при перезагрузке данных
+        apply_pending_edits()
+        _csv_etag = response.headers.get("ETag")
         
-    except requests.exceptions.RequestException as e:
+        if cache_data is not None:
+            # Кэш пишется уже после публикации: пока файл пишется, обработчики видят новый снимок
+            await asyncio.to_thread(save_data_to_cache, content_digest, updated_time, cache_data)
+        return True
+        
+    except httpx.HTTPError as e:
         logger.error(f"❌ Ошибка при скачивании файла с GitHub ({CSV_URL}): {e}")
         return False
     except Exception as e:
@@ -221,206 +802,378 @@ def load_data_from_git() -> bool:
         return False
 
 
-# --- ФУНКЦИИ РЕДАКТИРОВАНИЯ ДАННЫХ В GIT ---
-def update_github_file(new_csv_content: str, commit_message: str) -> bool:
-    """Обновляет файл разраб.csv на GitHub через API. Возвращает True/False."""
-    if not GITHUB_TOKEN or not REPO_DETAILS_FULL:
-        logger.error("❌ Отсутствуют GITHUB_TOKEN или GIT_REPO_DETAILS.")
-        return False
-        
+async def periodic_refresh() -> None:
+    """
+    Фоновая задача: сразу после запуска загружает данные с GitHub (поверх снимка, если он был),
+    затем раз в REFRESH_INTERVAL секунд подтягивает изменения CSV.
+    """
     try:
-        user, repo, branch, filepath = REPO_DETAILS_FULL.split('/', 3)
-    except ValueError:
-        logger.error(f"❌ Неверный формат GIT_REPO_DETAILS: {REPO_DETAILS_FULL}")
-        return False
+        await load_data_from_git()
+    except Exception as e:
+        logger.error(f"❌ Ошибка фонового обновления данных: {e}")
+    finally:
+        # Даже неудачная первая попытка завершает прогрев: дальше данные догрузит периодическое обновление
+        DATA_READY.set()
 
-    # 1. Получаем SHA текущего файла
-    contents_url = f"https://api.github.com/repos/{user}/{repo}/contents/{filepath}?ref={branch}"
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.com.v3.sha", # Более точный Accept для SHA
-    }
-    
+    while REFRESH_INTERVAL > 0:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        try:
+            await load_data_from_git()
+        except Exception as e:
+            logger.error(f"❌ Ошибка фонового обновления данных: {e}")
+
+
+# --- ФУНКЦИИ РЕДАКТИРОВАНИЯ ДАННЫХ В GIT ---
+async def fetch_github_file_sha() -> Optional[str]:
+    """Запрашивает у GitHub SHA текущей версии файла. Возвращает None при ошибке."""
     try:
-        response = requests.get(contents_url, headers=headers)
+        response = await github_request("GET", CONTENTS_URL, headers=CONTENTS_HEADERS)
         response.raise_for_status()
-        current_file_data = response.json()
-        current_sha = current_file_data['sha']
+        current_sha = orjson.loads(response.content)['sha']
         logger.info(f"Получен текущий SHA: {current_sha}")
-    except requests.exceptions.RequestException as e:
+        return current_sha
+    except httpx.HTTPError as e:
         logger.error(f"❌ Ошибка получения SHA файла: {e}")
-        return False
+        return None
 
-    # 2. Подготавливаем данные для нового коммита
-    encoded_content = base64.b64encode(new_csv_content.encode('utf-8')).decode('utf-8')
-    
+
+async def put_github_file(encoded_content: str, commit_message: str, current_sha: str) -> httpx.Response:
+    """Отправляет новое содержимое файла (base64) в Contents API поверх версии current_sha."""
     payload = {
         "message": commit_message,
         "content": encoded_content,
         "sha": current_sha,
-        "branch": branch
+        "branch": GH_BRANCH
     }
+    return await github_request("PUT", CONTENTS_URL, headers=CONTENTS_PUT_HEADERS, content=orjson.dumps(payload))
+
+
+async def update_github_file(new_csv_content: str, commit_message: str) -> bool:
+    """Обновляет файл разраб.csv на GitHub через API. Возвращает True/False."""
+    global _cached_file_sha
+    
+    if not GITHUB_TOKEN or not REPO_DETAILS_FULL:
+        logger.error("❌ Отсутствуют GITHUB_TOKEN или GIT_REPO_DETAILS.")
+        return False
+        
+    if CONTENTS_URL is None:
+        logger.error(f"❌ Неверный формат GIT_REPO_DETAILS: {REPO_DETAILS_FULL}")
+        return False
+
+    # 1. SHA текущего файла: берем из ответа на прошлый коммит, иначе запрашиваем у GitHub
+    sha_from_cache = _cached_file_sha is not None
+    current_sha = _cached_file_sha if sha_from_cache else await fetch_github_file_sha()
+    if current_sha is None:
+        return False
+
+    # 2. Подготавливаем данные для нового коммита
+    # pybase64 кодирует SIMD-инструкциями и сразу отдает str — без промежуточного bytes-объекта
+    encoded_content = pybase64.b64encode_as_string(new_csv_content.encode('utf-8'))
 
     # 3. Отправляем новый контент
     try:
-        response = requests.put(contents_url, headers=headers, json=payload)
+        response = await put_github_file(encoded_content, commit_message, current_sha)
+        
+        if response.status_code in (409, 422) and sha_from_cache:
+            # Файл изменили в обход бота — обновляем SHA и повторяем коммит один раз
+            logger.warning(f"⚠️ Кэшированный SHA устарел (HTTP {response.status_code}). Повторяю коммит с актуальным SHA.")
+            current_sha = await fetch_github_file_sha()
+            if current_sha is None:
+                _cached_file_sha = None
+                return False
+            response = await put_github_file(encoded_content, commit_message, current_sha)
         
         if response.status_code == 409:
             logger.error(f"❌ Конфликт (409) при коммите: файл был изменен.")
+            _cached_file_sha = None
             # Для API Proxy нужно будет обернуть это в HTTPException(409)
             # Но для сохранения сигнатуры просто возвращаем False
             return False 
             
         response.raise_for_status()
         
-        logger.info(f"✅ Файл {filepath} успешно обновлен на ветке {branch}. Коммит: {response.json()['commit']['sha']}")
+        commit_result = orjson.loads(response.content)
+        _cached_file_sha = commit_result['content']['sha']
+        logger.info(f"✅ Файл {GH_FILEPATH} успешно обновлен на ветке {GH_BRANCH}. Коммит: {commit_result['commit']['sha']}")
         
         # Обновляем локальный кэш сразу после успешного коммита
-        load_data_from_git()
+        await load_data_from_git()
         
         return True
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"❌ Ошибка коммита на GitHub: {e}")
+        _cached_file_sha = None
         return False
 
 
+def csv_record_lines() -> List[str]:
+    """
+    Заголовок и по одной записи на студента — в порядке индексов, без переводов строк между записями.
+    Запись со значением в кавычках может содержать перевод строки внутри, но остается одним элементом.
+    """
+    # Строки собираются простым join; csv.writer нужен только для значений с ';', кавычками или переводами строк.
+    lines = ['ID номер;ФИО;Количество пропусков']
+    quoting_output = None
+    
+    for student_id, name, absences in zip(IDS, NAMES, ABSENCES):
+        line = f"{student_id};{name};{absences}"
+        if line.count(';') != 2 or '"' in line or '\n' in line or '\r' in line:
+            if quoting_output is None:
+                quoting_output = io.StringIO()
+                quoting_writer = csv.writer(quoting_output, delimiter=';')
+            quoting_output.seek(0)
+            quoting_output.truncate()
+            quoting_writer.writerow((student_id, name, absences))
+            # Перевод строки writer'а отрезается уже после записи: по нему csv решает, брать ли значение в кавычки
+            line = quoting_output.getvalue()[:-2]
+        lines.append(line)
+    return lines
+
+
 def convert_data_to_csv_string() -> str:
-    """Преобразует текущий STUDENT_DATA в строку CSV."""
-    if not STUDENT_DATA:
+    """Преобразует текущие IDS, NAMES и ABSENCES в строку CSV."""
+    if not IDS:
         return "ID номер;ФИО;Количество пропусков\n"
-        
-    fieldnames = ['ID номер', 'ФИО', 'Количество пропусков']
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=fieldnames, delimiter=';') 
-    
-    # 1. Записываем заголовок
-    writer.writeheader()
-    
-    # 2. Записываем данные (используя отсортированные ID для сохранения порядка)
-    # NOTE: В исходном коде вы обходите STUDENT_DATA.items(). Для сохранения структуры CSV 
-    # нужно правильно восстановить словарь для записи, включая ID в строку данных.
     
-    # Создаем временный список объектов, где ID является частью объекта, а не ключом.
-    data_for_writer = []
-    
-    # Создаем список ключей, которые есть в заголовке, чтобы избежать ошибок
-    data_keys = [k for k in STUDENT_DATA[next(iter(STUDENT_DATA))].keys()] if STUDENT_DATA else []
-    
-    # Порядок столбцов должен быть ID номер, ФИО, Количество пропусков
-    for student_id, data in STUDENT_DATA.items():
-        row = {
-            'ID номер': student_id,
-            'ФИО': data.get('ФИО', 'Неизвестно'),
-            'Количество пропусков': data.get('Количество пропусков', 0)
-        }
-        data_for_writer.append(row)
-        
-    # DictWriter будет использовать только ключи из fieldnames
-    writer.writerows(data_for_writer)
-        
-    return output.getvalue()
+    # Перевод строки '\r\n' — как у csv.writer, чтобы файл на GitHub не менялся целиком.
+    lines = csv_record_lines()
+    lines.append('')
+    return '\r\n'.join(lines)
+
+
+def patch_csv_row(idx: int) -> None:
+    """
+    Записывает текущее значение ABSENCES[idx] в исходную строку студента в CSV_LINES.
+    Остальные строки файла не пересобираются; если точечная правка невозможна,
+    CSV_LINES строится заново через csv_record_lines().
+    """
+    global CSV_LINES, ROW_LINES, CSV_LAYOUT
+
+    line_no = ROW_LINES[idx] if CSV_LAYOUT and idx < len(ROW_LINES) else -1
+    if line_no < 0:
+        # Следующие правки применяются уже к пересобранному файлу, иначе это изменение потеряется.
+        # Запись студента idx — строка idx + 1 (после заголовка), поэтому файл не нужно разбирать заново
+        CSV_LINES = csv_record_lines()
+        ROW_LINES = array.array('i', range(1, len(CSV_LINES)))
+        CSV_LAYOUT = (';', 2, '\r\n')
+        return
+
+    delimiter_char, abs_col = CSV_LAYOUT[:2]
+    row = next(csv.reader((CSV_LINES[line_no],), delimiter=delimiter_char))
+    if len(row) <= abs_col:
+        row.extend([''] * (abs_col + 1 - len(row)))
+    row[abs_col] = str(ABSENCES[idx])
+
+    output = io.StringIO()
+    csv.writer(output, delimiter=delimiter_char).writerow(row)
+    # Перевод строки writer'а отрезается после записи: без него csv не возьмет в кавычки значение с переводом строки
+    CSV_LINES[line_no] = output.getvalue()[:-2]
+
+
+def build_csv_content() -> str:
+    """Собирает CSV для коммита из CSV_LINES со всеми примененными правками."""
+    if not CSV_LAYOUT:
+        return convert_data_to_csv_string()
+    newline = CSV_LAYOUT[2]
+    return newline.join(CSV_LINES) + newline
+
+
+# --- ОТЛОЖЕННЫЕ КОММИТЫ ПРАВОК ---
+def apply_pending_edits() -> None:
+    """Повторно применяет еще не закоммиченные правки к только что загруженным данным."""
+    for student_id, new_absences in PENDING_EDITS.items():
+        idx = IDS.get(student_id)
+        if idx is None:
+            continue
+        ABSENCES[idx] = new_absences
+        REPLY_CACHE.pop(student_id, None)
+        patch_csv_row(idx)
+
+
+def schedule_flush() -> None:
+    """Откладывает коммит правок: он уйдет, когда после последней правки пройдет COMMIT_DELAY секунд."""
+    global _last_edit_at, _flush_task
+
+    _last_edit_at = asyncio.get_running_loop().time()
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_after_idle())
+
+
+async def _flush_after_idle() -> None:
+    """Ждет паузы в правках, коммитит их и сообщает результат администратору."""
+    global _flush_task
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + COMMIT_MAX_DELAY
+    while (remaining := min(_last_edit_at + COMMIT_DELAY, deadline) - loop.time()) > 0:
+        await asyncio.sleep(remaining)
+
+    # Правки, пришедшие во время коммита, должны запустить новое ожидание, а не повиснуть до следующей правки
+    _flush_task = None
+    try:
+        edits_count = len(PENDING_EDITS)
+        result = await flush_pending_edits()
+        if result is None or application is None:
+            return
+        if result:
+            text = f"🎉 Изменения пропусков ({edits_count}) зафиксированы на GitHub."
+        else:
+            text = (
+                "⚠️ <b>Критическая ошибка коммита!</b>\n"
+                "Правки сохранены локально, но коммит на GitHub не удался. Проверьте логи и повторите командой /flush."
+            )
+        await application.bot.send_message(chat_id=ADMIN_USER_ID, text=text, parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"❌ Ошибка отложенного коммита правок: {e}")
+
+
+async def flush_pending_edits() -> Optional[bool]:
+    """
+    Отправляет все накопленные правки одним коммитом.
+    Возвращает None, если отправлять нечего, иначе результат update_github_file.
+    """
+    async with _flush_lock:
+        if not PENDING_EDITS:
+            return None
+
+        # Правки остаются в PENDING_EDITS до успешного коммита: перезагрузка данных во время PUT применит их заново
+        edits = dict(PENDING_EDITS)
+
+        summary = []
+        for student_id, new_absences in edits.items():
+            idx = IDS.get(student_id)
+            student_name = NAMES[idx] if idx is not None else 'Неизвестно'
+            summary.append(f"{student_name} ({student_id}) -> {new_absences}")
+
+        if len(summary) == 1:
+            commit_message = f"🤖 Обновление пропусков: {summary[0]}"
+        else:
+            commit_message = f"🤖 Обновление пропусков ({len(summary)})\n\n" + "\n".join(summary)
+
+        if await update_github_file(build_csv_content(), commit_message):
+            # Убираем только закоммиченные значения: более свежие правки, пришедшие во время PUT, остаются в очереди
+            for student_id, new_absences in edits.items():
+                if PENDING_EDITS.get(student_id) == new_absences:
+                    del PENDING_EDITS[student_id]
+            logger.info(f"✅ Отправлено правок одним коммитом: {len(edits)}")
+            return True
+
+        return False
 
 
 # --- ОБРАБОТЧИКИ КОМАНД ПОЛЬЗОВАТЕЛЯ ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает команду /start."""
-    user_id = context.user_data.get(USER_ID_KEY)
+    user_id = USER_ID_MAP.get(update.effective_user.id)
 
     if user_id:
-        reply_text = (
-            f'С возвращением! Ваш текущий ID Номер: **{user_id}**.\n'
-            'Нажмите кнопку "📊 Посмотреть количество пропусков" ниже, чтобы узнать актуальные данные.\n\n'
-            f'⏳ *Данные предоставлены за {LAST_UPDATED_TIME}.*' 
-        )
-        keyboard = get_main_keyboard()
+        reply_text = WELCOME_BACK_TMPL.format(sid=html.escape(user_id), updated=LAST_UPDATED_TIME)
+        keyboard = MAIN_KEYBOARD
     else:
-        reply_text = (
-            'Привет! 👋 Я бот для проверки пропусков в ВУЗе.\n'
-            'Для начала работы, пожалуйста, **введите свой ID Номер** (номер студенческого билета).'
-        )
-        keyboard = remove_keyboard()
+        reply_text = WELCOME_TEXT
+        keyboard = REMOVE_KEYBOARD
 
-    await update.message.reply_text(reply_text, reply_markup=keyboard, parse_mode='Markdown')
+    await update.message.reply_text(reply_text, reply_markup=keyboard, parse_mode='HTML')
 
 
 async def change_id_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Запускает процесс смены ID Номера."""
+    global _user_ids_dirty
     await update.message.reply_text(
         'Хорошо, введите, пожалуйста, новый ID Номер.',
-        reply_markup=remove_keyboard()
+        reply_markup=REMOVE_KEYBOARD
     )
-    if USER_ID_KEY in context.user_data:
-        del context.user_data[USER_ID_KEY]
+    USER_ID_MAP.pop(update.effective_user.id, None)
+    _user_ids_dirty = True
+
+
+def format_student_reply(student_id: str) -> str:
+    """Возвращает текст ответа с пропусками студента, формируя его один раз до перезагрузки данных."""
+    reply_text = REPLY_CACHE.get(student_id)
+    
+    if reply_text is None:
+        idx = IDS[student_id]
+        reply_text = STUDENT_REPLY_TMPL.format(
+            name=html.escape(NAMES[idx]),
+            sid=html.escape(student_id),
+            absences=ABSENCES[idx],
+            updated=LAST_UPDATED_TIME
+        )
+        REPLY_CACHE[student_id] = reply_text
+        
+    return reply_text
 
 
 async def process_data_request(update: Update, context: ContextTypes.DEFAULT_TYPE, search_id: str) -> None:
     """Извлекает и форматирует данные о пропусках по ID."""
     
-    if search_id in STUDENT_DATA:
-        student = STUDENT_DATA[search_id]
-        name = student.get('ФИО', 'Неизвестно')
-        absences = student.get('Количество пропусков', 0)
-            
-        reply_text = (
-            f"👤 **Студент:** {name}\n"
-            f"🆔 **ID:** `{search_id}`\n"
-            f"📚 **Количество пропусков (в часах):** {absences}\n\n"
-            f'⏳ *Данные предоставлены за {LAST_UPDATED_TIME}.*' 
-        )
+    if search_id in IDS:
+        reply_text = format_student_reply(search_id)
     else:
         reply_text = (
             '❌ Ошибка данных. Пожалуйста, введите свой ID Номер снова.'
         )
 
-    await update.message.reply_text(reply_text, parse_mode='Markdown', reply_markup=get_main_keyboard())
+    await update.message.reply_text(reply_text, parse_mode='HTML', reply_markup=MAIN_KEYBOARD)
+
+
+async def check_passes_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает пропуски по сохраненному ID Номеру (кнопка "📊 Посмотреть количество пропусков")."""
+    search_id = USER_ID_MAP.get(update.effective_user.id)
+    if not search_id:
+        return await start_command(update, context)
+
+    await process_data_request(update, context, search_id)
+
+
+# Обработчики кнопок главной клавиатуры: текст кнопки -> корутина
+BUTTON_HANDLERS = {
+    BTN_CHECK_PASSES: check_passes_handler,
+    BTN_CHANGE_ID: change_id_handler,
+}
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает текстовый ввод (как ИД) или нажатие кнопки."""
+    global _user_ids_dirty
     if not update.message or not update.message.text: return
     user_input = update.message.text.strip()
-    search_id = None
 
-    if user_input == BTN_CHECK_PASSES:
-        search_id = context.user_data.get(USER_ID_KEY)
-        if not search_id:
-            return await start_command(update, context)
+    button_handler = BUTTON_HANDLERS.get(user_input)
+    if button_handler:
+        return await button_handler(update, context)
 
-    elif user_input == BTN_CHANGE_ID:
-        return await change_id_handler(update, context)
-
-    else:
-        search_id = user_input.strip() 
+    # Любой другой текст считаем вводом ID Номера; явно не похожий на номер отсекаем сразу
+    if not _ID_RE.fullmatch(user_input):
+        return await update.message.reply_text(
+            '🤔 Извините, я не понимаю. Введите ваш ID Номер или нажмите /start.'
+        )
 
-        if search_id not in STUDENT_DATA:
-            message = (
-                f'❌ ID Номер **{search_id}** не найден в нашей базе.\n'
-                'Пожалуйста, проверьте правильность ввода и попробуйте снова.'
-            )
-            return await update.message.reply_text(message, parse_mode='Markdown', reply_markup=remove_keyboard())
+    search_id = sys.intern(user_input)
 
-        context.user_data[USER_ID_KEY] = search_id
-        name = STUDENT_DATA[search_id].get('ФИО', 'Студент')
-        
+    if search_id not in IDS:
         message = (
-            f'✅ Здравствуйте, **{name}**!\n'
-            f'Ваш ID Номер **{search_id}** успешно сохранен.\n'
-            'Теперь вы можете просто нажать кнопку "📊 Посмотреть количество пропусков".'
+            f'❌ ID Номер <b>{html.escape(search_id)}</b> не найден в нашей базе.\n'
+            'Пожалуйста, проверьте правильность ввода и попробуйте снова.'
         )
-        await update.message.reply_text(
-            message,
-            reply_markup=get_main_keyboard(),
-            parse_mode='Markdown'
-        )
-        return await process_data_request(update, context, search_id)
+        return await update.message.reply_text(message, parse_mode='HTML', reply_markup=REMOVE_KEYBOARD)
 
-    if search_id:
-        await process_data_request(update, context, search_id)
-    else:
-        await update.message.reply_text(
-            '🤔 Извините, я не понимаю. Введите ваш ID Номер или нажмите /start.'
-        )
+    USER_ID_MAP[update.effective_user.id] = search_id
+    _user_ids_dirty = True
+    name = NAMES[IDS[search_id]]
+    
+    message = (
+        f'✅ Здравствуйте, <b>{html.escape(name)}</b>!\n'
+        f'Ваш ID Номер <b>{html.escape(search_id)}</b> успешно сохранен.\n'
+        'Теперь вы можете просто нажать кнопку "📊 Посмотреть количество пропусков".'
+    )
+    # Приветствие и пропуски уходят одним сообщением: один запрос к Telegram вместо двух
+    await update.message.reply_text(
+        f'{message}\n\n{format_student_reply(search_id)}',
+        reply_markup=MAIN_KEYBOARD,
+        parse_mode='HTML'
+    )
 
 # --- КОМАНДЫ АДМИНИСТРАТОРА ---
 async def reload_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -433,15 +1186,34 @@ async def reload_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     await update.message.reply_text("⏳ Начинаю загрузку актуальных данных из Git...")
     
-    if load_data_from_git():
+    if await load_data_from_git(force=True):
         await update.message.reply_text(
-            f"✅ Данные успешно обновлены! Загружено {len(STUDENT_DATA)} записей. Дата: {LAST_UPDATED_TIME}"
+            f"✅ Данные успешно обновлены! Загружено {len(IDS)} записей. Дата: {LAST_UPDATED_TIME}"
         )
     else:
         await update.message.reply_text(
             "❌ Ошибка загрузки данных. Проверьте логи и переменную CSV_URL."
         )
 
+
+async def flush_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда для администратора: немедленно отправить накопленные правки на GitHub."""
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("❌ У вас нет прав на выполнение этой команды.")
+        return
+
+    result = await flush_pending_edits()
+    if result is None:
+        await update.message.reply_text("ℹ️ Неотправленных правок нет.")
+    elif result:
+        await update.message.reply_text("🎉 Все правки зафиксированы на GitHub.")
+    else:
+        await update.message.reply_text(
+            "⚠️ <b>Критическая ошибка коммита!</b>\n"
+            "Правки сохранены локально, но коммит на GitHub не удался (возможно, конфликт или неверный токен). Проверьте логи.",
+            parse_mode='HTML'
+        )
+
 # --- ОБРАБОТЧИКИ ДЛЯ РЕДАКТИРОВАНИЯ ДАННЫХ (ConversationHandler) ---
 
 async def start_edit_pass_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -451,9 +1223,9 @@ async def start_edit_pass_command(update: Update, context: ContextTypes.DEFAULT_
         return ConversationHandler.END
 
     await update.message.reply_text(
-        "📝 **Режим редактирования пропусков**\nВведите ID Номер студента, пропуски которого нужно изменить.",
-        reply_markup=remove_keyboard(),
-        parse_mode='Markdown'
+        "📝 <b>Режим редактирования пропусков</b>\nВведите ID Номер студента, пропуски которого нужно изменить.",
+        reply_markup=REMOVE_KEYBOARD,
+        parse_mode='HTML'
     )
     return GETTING_ID
 
@@ -463,22 +1235,23 @@ async def get_student_id(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not update.message or not update.message.text: return GETTING_ID
     student_id = update.message.text.strip()
     
-    if student_id not in STUDENT_DATA:
+    if student_id not in IDS:
         await update.message.reply_text(
-            f"❌ ID Номер **{student_id}** не найден в базе. Попробуйте снова или нажмите /cancel.",
-            parse_mode='Markdown'
+            f"❌ ID Номер <b>{html.escape(student_id)}</b> не найден в базе. Попробуйте снова или нажмите /cancel.",
+            parse_mode='HTML'
         )
         return GETTING_ID
 
     context.user_data['temp_edit_id'] = student_id
-    current_absences = STUDENT_DATA[student_id].get('Количество пропусков', 0)
-    student_name = STUDENT_DATA[student_id].get('ФИО', 'Неизвестно')
+    idx = IDS[student_id]
+    current_absences = ABSENCES[idx]
+    student_name = NAMES[idx]
     
     await update.message.reply_text(
-        f"✅ ID Номер **{student_id}** ({student_name}) найден.\n"
-        f"Текущее количество пропусков: **{current_absences}**.\n"
-        "Введите **новое** количество пропусков (целое число):",
-        parse_mode='Markdown'
+        f"✅ ID Номер <b>{html.escape(student_id)}</b> ({html.escape(student_name)}) найден.\n"
+        f"Текущее количество пропусков: <b>{current_absences}</b>.\n"
+        "Введите <b>новое</b> количество пропусков (целое число):",
+        parse_mode='HTML'
     )
     return GETTING_ABSENCES
 
@@ -490,7 +1263,7 @@ async def get_absences_count(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     try:
         new_absences = int(new_absences_str)
-        if new_absences < 0:
+        if not 0 <= new_absences <= MAX_ABSENCES:
              raise ValueError
     except ValueError:
         await update.message.reply_text(
@@ -499,32 +1272,25 @@ async def get_absences_count(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return GETTING_ABSENCES
 
     student_id = context.user_data.pop('temp_edit_id')
-    student_name = STUDENT_DATA[student_id].get('ФИО', 'Неизвестно')
-    
-    # 1. Обновление локальных данных
-    STUDENT_DATA[student_id]['Количество пропусков'] = new_absences
+    idx = IDS[student_id]
+    student_name = NAMES[idx]
     
-    # 2. Формирование нового CSV
-    new_csv_content = convert_data_to_csv_string()
+    # 1. Обновление локальных данных (меняется только строка этого студента в CSV)
+    ABSENCES[idx] = new_absences
+    REPLY_CACHE.pop(student_id, None)
+    patch_csv_row(idx)
     
-    # 3. Коммит на GitHub
-    commit_message = f"🤖 Обновление пропусков: {student_name} ({student_id}) -> {new_absences}"
+    # 2. Коммит на GitHub откладывается: правки, сделанные подряд, уйдут одним коммитом
+    PENDING_EDITS[student_id] = new_absences
+    schedule_flush()
     
-    await update.message.reply_text("⏳ Данные обновлены локально. Отправляю коммит на GitHub...")
-    
-    if update_github_file(new_csv_content, commit_message):
-        final_message = (
-            f"🎉 Успешно!\n"
-            f"Пропуски для **{student_name}** (`{student_id}`) установлены на **{new_absences}**.\n"
-            "Изменение зафиксировано на GitHub. Чтобы обновить дату в сообщениях, выполните команду /reload_data."
-        )
-    else:
-        final_message = (
-            "⚠️ **Критическая ошибка коммита!**\n"
-            "Локальные данные обновлены, но коммит на GitHub не удался (возможно, конфликт или неверный токен). Проверьте логи."
-        )
+    final_message = (
+        f"✅ Пропуски для <b>{html.escape(student_name)}</b> (<code>{html.escape(student_id)}</code>) установлены на <b>{new_absences}</b>.\n"
+        f"Изменение будет отправлено на GitHub через {COMMIT_DELAY} с после последней правки "
+        f"(в очереди: {len(PENDING_EDITS)}). Отправить сразу: /flush."
+    )
 
-    await update.message.reply_text(final_message, parse_mode='Markdown', reply_markup=get_main_keyboard())
+    await update.message.reply_text(final_message, parse_mode='HTML', reply_markup=MAIN_KEYBOARD)
     return ConversationHandler.END
 
 
@@ -535,7 +1301,7 @@ async def cancel_edit_pass(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         
     await update.message.reply_text(
         'Операция редактирования отменена.', 
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
     return ConversationHandler.END
 
@@ -545,6 +1311,13 @@ fastapi_app = FastAPI()
 
 
 # --- ЭНДПОИНТЫ FASTAPI ---
+# Ответы webhook постоянны: сериализуем их через orjson один раз, а не на каждый апдейт
+WEBHOOK_OK_BODY = orjson.dumps({"status": "ok"})
+WEBHOOK_ERROR_BODY = orjson.dumps({"status": "error", "message": "Internal error processing update"})
+HEALTH_OK_BODY = orjson.dumps({"status": "ok", "app": "Telegram Bot Webhook"})
+HEALTH_LOADING_BODY = orjson.dumps({"status": "loading", "app": "Telegram Bot Webhook"})
+# Ответ health check не должен кэшироваться прокси — иначе монитор увидит устаревший статус
+NO_STORE_HEADERS = {"Cache-Control": "no-store"}
 
 # Health Check Endpoint 
 @fastapi_app.get("/health", status_code=200) # Переносим health check на /health
@@ -554,7 +1327,8 @@ async def health_check_get(request: Request):
     Используется для проверки работоспособности сервиса (Health Check).
     """
     logger.info(f"✅ Health Check (GET /health) received from {request.client.host}. Responding 200 OK.")
-    return {"status": "ok", "app": "Telegram Bot Webhook"}
+    body = HEALTH_OK_BODY if DATA_READY.is_set() else HEALTH_LOADING_BODY
+    return Response(content=body, media_type="application/json", headers=NO_STORE_HEADERS)
 
 @fastapi_app.head("/health", status_code=200) # Переносим health check на /health
 async def health_check_head(request: Request):
@@ -563,7 +1337,7 @@ async def health_check_head(request: Request):
     Используется мониторами для быстрой проверки. Возвращает только заголовки (200 OK).
     """
     logger.info(f"✅ Health Check (HEAD /health) received from {request.client.host}. Responding 200 OK.")
-    return Response(status_code=200)
+    return Response(status_code=200, headers=NO_STORE_HEADERS)
 
 # API Proxy Endpoint для админ-панели (использует GITHUB_TOKEN с сервера)
 @fastapi_app.post("/api/update_data")
@@ -573,7 +1347,8 @@ async def update_data_proxy(request: Request):
     и безопасно отправляет коммит в GitHub, используя GITHUB_TOKEN сервера.
     """
     try:
-        data = await request.json()
+        # Тело с CSV может быть большим — разбираем его orjson, как и апдейты webhook
+        data = orjson.loads(await request.body())
         new_csv_content = data.get("new_csv_content")
         commit_message = data.get("commit_message")
         
@@ -583,15 +1358,18 @@ async def update_data_proxy(request: Request):
         logger.info(f"Запрос API Proxy: Попытка коммита с сообщением: '{commit_message}'")
         
         # Вызов существующей функции обновления Git
-        if update_github_file(new_csv_content, commit_message):
+        if await update_github_file(new_csv_content, commit_message):
             # После успешного коммита load_data_from_git() был вызван внутри update_github_file
-            return JSONResponse(content={"message": "Данные успешно сохранены на GitHub через прокси.", "last_updated": LAST_UPDATED_TIME})
+            return Response(
+                content=orjson.dumps({"message": "Данные успешно сохранены на GitHub через прокси.", "last_updated": LAST_UPDATED_TIME}),
+                media_type="application/json"
+            )
         else:
             # Поскольку update_github_file возвращает False и при ошибке, и при 409 конфликте, 
             # мы даем общий, но информативный ответ.
             raise HTTPException(status_code=500, detail="Ошибка при создании коммита на GitHub. Проверьте токен, права доступа и логи сервера. Возможно, произошел конфликт версий файла (409).")
 
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Некорректный JSON в запросе.")
     except HTTPException:
         # Перебрасываем HTTPException
@@ -604,21 +1382,41 @@ async def update_data_proxy(request: Request):
 # Webhook Endpoint 
 @fastapi_app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
-    """Принимает POST-запросы от Telegram и вручную передает их в PTB."""
+    """Принимает POST-запросы от Telegram и передает их в PTB, не дожидаясь обработки."""
     global application
 
     if application is None:
         raise HTTPException(status_code=503, detail="Bot application not initialized.")
 
+    # Отсекаем чужие запросы по заголовку до разбора JSON
+    if WEBHOOK_SECRET:
+        received_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(received_secret.encode(), WEBHOOK_SECRET.encode()):
+            logger.warning(f"⚠️ Webhook-запрос с неверным секретом от {request.client.host}. Отклонен.")
+            raise HTTPException(status_code=403, detail="Invalid secret token.")
+
+    # Данные еще загружаются: Telegram повторит доставку апдейта позже
+    if not DATA_READY.is_set():
+        raise HTTPException(status_code=503, detail="Warming up.")
+
     try:
-        update_json = await request.json()
+        update_json = orjson.loads(await request.body())
         update = Update.de_json(update_json, application.bot)
-        await application.process_update(update) 
-        return {"status": "ok"}
+        
+        # Лимит считает и ждущие в очереди, и уже обрабатываемые апдейты
+        if not application.update_processor.try_reserve():
+            logger.warning(f"⚠️ Необработанных апдейтов уже {MAX_PENDING_UPDATES}. Telegram повторит доставку позже.")
+            raise HTTPException(status_code=503, detail="Too many pending updates.")
+        
+        # Подтверждаем получение сразу: апдейт обработает сам PTB, забрав его из очереди
+        application.update_queue.put_nowait(update)
+        return Response(content=WEBHOOK_OK_BODY, media_type="application/json")
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Ошибка обработки Telegram update: {e}")
-        return {"status": "error", "message": "Internal error processing update"}
+        return Response(content=WEBHOOK_ERROR_BODY, media_type="application/json")
 
 
 # --- ФУНКЦИИ ЖИЗНЕННОГО ЦИКЛА FASTAPI ---
@@ -626,18 +1424,38 @@ async def telegram_webhook(request: Request):
 @fastapi_app.on_event("startup")
 async def startup_event():
     """Выполняется при запуске Uvicorn. Инициализирует PTB и устанавливает WebHook."""
-    global application
+    global application, _refresh_task, _user_state_task
+    
+    # 1. Загрузка данных: снимок с прошлого запуска поднимается сразу, а свежий CSV догружается в фоне.
+    # Запуск не ждет GitHub — без снимка webhook отвечает 503, пока идет первая загрузка
+    if load_data_from_cache():
+        DATA_READY.set()
+    _refresh_task = asyncio.create_task(periodic_refresh())
     
-    # 1. Загрузка данных (включая попытку получить дату обновления)
-    load_data_from_git()
+    # Регистрации пользователей переживают перезапуск процесса
+    load_user_ids()
+    _user_state_task = asyncio.create_task(periodic_user_ids_flush())
     
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
         logger.error("❌ Токен бота не найден. Установите переменную окружения TELEGRAM_BOT_TOKEN.")
         raise ValueError("TELEGRAM_BOT_TOKEN не установлен")
         
+    # Пул соединений к api.telegram.org рассчитан на пачки одновременных ответов
+    bot_request = OrjsonHTTPXRequest(
+        connection_pool_size=100,
+        connect_timeout=5.0,
+        read_timeout=10.0,
+        pool_timeout=1.0
+    )
+    # Webhook принимает FastAPI, поэтому Updater не нужен; апдейты разных пользователей обрабатываются параллельно,
+    # одного пользователя — по очереди, как того требует ConversationHandler
     application = ApplicationBuilder() \
         .token(token) \
+        .base_url(TELEGRAM_API_URL) \
+        .request(bot_request) \
+        .updater(None) \
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES, MAX_PENDING_UPDATES)) \
         .build()
 
     edit_pass_handler = ConversationHandler(
@@ -652,6 +1470,7 @@ async def startup_event():
     # Добавление обработчиков
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("reload_data", reload_data_command)) 
+    application.add_handler(CommandHandler("flush", flush_command))
     application.add_handler(edit_pass_handler) 
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
@@ -665,7 +1484,8 @@ async def startup_event():
             logger.info(f"Setting webhook to: {webhook_url_full}")
             await application.bot.set_webhook(
                 url=webhook_url_full,
-                allowed_updates=Update.ALL_TYPES
+                allowed_updates=[Update.MESSAGE],
+                secret_token=WEBHOOK_SECRET
             )
             logger.info("✅ Webhook set successfully.")
         except Exception as e:
@@ -673,15 +1493,39 @@ async def startup_event():
     else:
         logger.warning("⚠️ WEBHOOK_URL environment variable is missing or invalid. Webhook might not be set.")
     
+    if not WEBHOOK_SECRET:
+        logger.warning("⚠️ TG_WEBHOOK_SECRET не задан. Входящие webhook-запросы не проверяются.")
+    
     logger.info("🚀 Бот полностью настроен и запущен.")
 
 @fastapi_app.on_event("shutdown")
 async def shutdown_event():
     """Выполняется при остановке Uvicorn. Корректно останавливает PTB."""
     global application
+    if _refresh_task:
+        _refresh_task.cancel()
+    if _user_state_task:
+        _user_state_task.cancel()
+    
     if application:
         await application.stop()
+        await application.shutdown()
         logger.info("🛑 PTB Application stopped gracefully.")
+    # Сохраняем после stop(): PTB еще обрабатывает апдейты из очереди, и в них бывают новые регистрации
+    await save_user_ids()
+    
+    # Новых правок после остановки PTB не будет: не ждем паузы и отправляем накопленные сразу
+    if _flush_task:
+        _flush_task.cancel()
+    # Коммит, который уже отправляется, дожидаемся: при ошибке его правки так и остаются в PENDING_EDITS
+    async with _flush_lock:
+        pass
+    if PENDING_EDITS:
+        logger.info(f"⏳ Отправляю неотправленные правки перед остановкой: {len(PENDING_EDITS)}")
+        if not await flush_pending_edits():
+            logger.error(f"❌ Правки не отправлены на GitHub и будут потеряны: {PENDING_EDITS}")
+    
+    await HTTP_CLIENT.aclose()
 
 # --- ОБСЛУЖИВАНИЕ СТАТИЧЕСКИХ ФАЙЛОВ АДМИН-ПАНЕЛИ (ДОБАВЛЕНО) ---
 
@@ -689,3 +1533,14 @@ async def shutdown_event():
 # Это позволит FastAPI обслуживать index.html как основную страницу.
 # Я переместил health checks на /health, чтобы избежать конфликтов с index.html
 fastapi_app.mount("/", StaticFiles(directory="static", html=True), name="static")
+
+
+# --- ТОЧКА ВХОДА ---
+def main() -> None:
+    """Запускает Uvicorn с уже импортированным fastapi_app (модуль не импортируется повторно)."""
+    # Один процесс: данные, регистрации и отложенные правки живут в памяти и не делятся между воркерами
+    uvicorn.run(fastapi_app, host=LISTEN_HOST, port=PORT, loop="uvloop", http="httptools")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 #!/bin/bash
 
-# Запуск Uvicorn-сервера, который будет слушать на порте 10000 
-# (это стандартный порт на Render). 
-# Он запускает FastAPI-приложение (fastapi_app), 
-# которое находится в файле app.py.
+# Запуск Uvicorn-сервера через точку входа main() в app.py.
+# Порт берется из переменной окружения PORT (на Render по умолчанию 10000),
+# хост — из HOST. Цикл событий — uvloop (libuv) вместо стандартного asyncio,
+# HTTP-парсер — httptools вместо h11.
+#
+# Регистрации пользователей (USER_STATE_PATH) и снимок данных (DATA_CACHE_PATH) по умолчанию лежат в /tmp,
+# который на Render очищается при каждом деплое. Чтобы пользователям не приходилось заново вводить ID Номер,
+# направьте обе переменные на подключенный persistent disk, например:
+#   USER_STATE_PATH=/var/data/user_ids.pkl DATA_CACHE_PATH=/var/data/students.pkl
 
-echo "Starting Uvicorn server on port 10000..."
-uvicorn app:fastapi_app --host 0.0.0.0 --port 10000
+echo "Starting Uvicorn server on port ${PORT:-10000}..."
+exec python app.py